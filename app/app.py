@@ -1,21 +1,33 @@
 import os
-import io
+import re
+import secrets
+import asyncio
 import json as pyjson  # avoid name clash with form field "json"
-
-from .auth import acquire_token_by_authorization_code, get_auth_url
-import boto3
-import msal
-
-from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException, Depends
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from .auth import acquire_token_by_authorization_code, build_msal_app, get_auth_url
+from aiobotocore.session import get_session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from cachetools import TLRUCache
+import orjson
+import pybase64
+
+from fastapi import FastAPI, Request, UploadFile, HTTPException, Depends, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from starlette.middleware.sessions import SessionMiddleware
+from starlette.datastructures import FormData, UploadFile as StarletteUploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+from starsessions import SessionAutoloadMiddleware, SessionMiddleware
 from itsdangerous import URLSafeSerializer
 
-from .config import SESSION_SECRET, S3_BUCKET_NAME, CLIENT_ID, AUTHORITY, CLIENT_SECRET, REDIRECT_PATH
+from .config import APP_BASE_URL, SESSION_SECRET, SESSION_TTL, S3_BUCKET_NAME, REDIRECT_PATH
 from .core import transform_json
+from .sessions import build_session_store, regenerate_session
 
 def get_current_user(request: Request):
     user = request.session.get("user")
@@ -24,29 +36,135 @@ def get_current_user(request: Request):
     return user
 
 def require_admin(user=Depends(get_current_user)):
-    roles = user.get("roles") or []
-    if "Admin" not in roles:
+    # is_admin is derived from the token roles once, at login
+    if not user.get("is_admin"):
         raise HTTPException(status_code=403, detail="Not enough permissions")
     return user
 
-def get_app_only_token() -> str:
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+
+# App-only tokens by audience, each dropped a minute before it expires.
+# Values are (access_token, expires_in) tuples.
+app_token_cache = TLRUCache(maxsize=16, ttu=lambda _key, value, now: now + value[1] - 60)
+app_token_lock = asyncio.Lock()
+
+def acquire_app_only_token() -> dict:
+    # Served from the shared MSAL token cache while the cached token is still valid
+    return build_msal_app().acquire_token_for_client(scopes=GRAPH_SCOPES)
+
+async def get_app_only_token() -> str:
     """
     Get an app-only Microsoft Graph access token.
     Uses application permissions (Sites.ReadWrite.All).
+    Concurrent callers share one refresh instead of each asking MSAL for a token.
     """
-    app = msal.ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET,
-    )
-    result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-    if "access_token" not in result:
-        raise RuntimeError(f"Failed to get app-only token: {result}")
-    return result["access_token"]
+    if cached := app_token_cache.get("graph"):
+        return cached[0]
+
+    async with app_token_lock:
+        # Another caller may have refreshed the token while we waited
+        if cached := app_token_cache.get("graph"):
+            return cached[0]
+
+        # MSAL blocks on network I/O
+        result = await run_in_threadpool(acquire_app_only_token)
+        if "access_token" not in result:
+            raise RuntimeError(f"Failed to get app-only token: {result}")
+
+        app_token_cache["graph"] = (result["access_token"], int(result.get("expires_in", 0)))
+        return result["access_token"]
+
+# Uploads are read in multiples of 3 bytes so every chunk base64-encodes without padding
+UPLOAD_CHUNK_SIZE = 3 * 64 * 1024
+
+async def iter_base64(upload: UploadFile) -> AsyncIterator[bytes]:
+    """
+    Base64-encode an upload chunk by chunk, so the raw file is never held in memory as a whole.
+    UploadFile is backed by a SpooledTemporaryFile, so reads only come back short at EOF.
+    """
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        yield pybase64.b64encode(chunk)
+
+S3_CHUNK_SIZE = 64 * 1024
+
+# Sized for concurrent /dashboard and /convert requests sharing one client
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    connect_timeout=3,
+    read_timeout=30,
+)
+
+s3_session = get_session()
 
-s3_client = boto3.client("s3")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Keep one S3 client open for the lifetime of the process,
+    so its HTTPS connection pool is reused across requests.
+    """
+    async with s3_session.create_client("s3", config=S3_CLIENT_CONFIG) as client:
+        app.state.s3_client = client
+        yield
+
+def get_s3_client(request: Request):
+    return request.app.state.s3_client
+
+# Objects larger than one part are downloaded with parallel ranged reads
+S3_PART_SIZE = 1024 * 1024
+S3_MAX_PARALLEL_PARTS = 16
+
+async def read_s3_body(obj) -> bytearray:
+    data = bytearray()
+    async with obj["Body"] as body:
+        async for chunk in body.iter_chunks(S3_CHUNK_SIZE):
+            data += chunk
+    return data
 
-app = FastAPI()
+async def read_s3_object(s3_client, key: str) -> bytearray:
+    """
+    Download an object from the bucket.
+    The first request reads up to S3_PART_SIZE bytes and reveals the total size;
+    the rest is fetched in up to S3_MAX_PARALLEL_PARTS concurrent ranged reads.
+    """
+    try:
+        obj = await s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key, Range=f"bytes=0-{S3_PART_SIZE - 1}")
+    except ClientError as e:
+        # S3 rejects any range on an empty object
+        if e.response.get("Error", {}).get("Code") == "InvalidRange":
+            return bytearray()
+        raise
+    first = await read_s3_body(obj)
+    total = int(obj["ContentRange"].rsplit("/", 1)[1])
+    if len(first) >= total:
+        return first
+
+    data = bytearray(total)
+    data[:len(first)] = first
+    remaining = total - len(first)
+    part_size = max(S3_PART_SIZE, -(-remaining // S3_MAX_PARALLEL_PARTS))
+
+    async def read_part(start: int):
+        end = min(start + part_size, total)
+        part = await s3_client.get_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=key,
+            Range=f"bytes={start}-{end - 1}",
+            IfMatch=obj["ETag"],  # fail instead of stitching together two versions
+        )
+        data[start:end] = await read_s3_body(part)
+
+    await asyncio.gather(*(read_part(start) for start in range(len(first), total, part_size)))
+    return data
+
+async def delete_s3_object(s3_client, key: str):
+    try:
+        await s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except Exception as e:
+        # Not fatal for the download; just log it
+        print(f"Failed to delete original JSON from S3 ({key}): {e}")
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -58,11 +176,30 @@ app.add_middleware(
 static_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "assets")
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
-app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET)
+# Load the session for everything except static files
+app.add_middleware(SessionAutoloadMiddleware, paths=[re.compile(r"^(?!/static/)")])
+app.add_middleware(
+    SessionMiddleware,
+    store=build_session_store(),
+    lifetime=SESSION_TTL,
+    rolling=True,
+    cookie_https_only=APP_BASE_URL.startswith("https://"),
+)
 
 templates = Jinja2Templates(directory="templates")
 state_serializer = URLSafeSerializer(SESSION_SECRET, salt="state-salt")
 
+# The login state is kept in its own short-lived cookie, not in the session,
+# so an anonymous /login never creates a server-side session entry
+STATE_COOKIE = "auth_state"
+STATE_COOKIE_MAX_AGE = 600
+
+def base_ctx(request: Request) -> dict:
+    """
+    Template context shared by every page; handlers add their own keys with `|`.
+    """
+    return {"request": request, "user": request.session.get("user")}
+
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     """
@@ -72,19 +209,27 @@ async def root(request: Request):
     user = request.session.get("user")
     if user:
         return RedirectResponse(url='/dashboard')
-    return templates.TemplateResponse("login.html", {"request": request, "user": None})
+    return templates.TemplateResponse("login.html", base_ctx(request))
 
 @app.get("/login")
 async def login(request: Request):
     """
     Redirect to Microsoft login.
     """
-    # Create a CSRF-safe state and store it in session
-    state = state_serializer.dumps({"csrf": "token"})
-    request.session["state"] = state
+    # Create a CSRF-safe state and keep it in a cookie sent only to the callback
+    state = state_serializer.dumps({"csrf": secrets.token_urlsafe(16)})
 
     auth_url = get_auth_url(state)
-    return RedirectResponse(url=auth_url)
+    response = RedirectResponse(url=auth_url)
+    response.set_cookie(
+        STATE_COOKIE,
+        state,
+        max_age=STATE_COOKIE_MAX_AGE,
+        path=REDIRECT_PATH,
+        secure=APP_BASE_URL.startswith("https://"),
+        httponly=True,
+    )
+    return response
 
 @app.get("/logout")
 async def logout(request: Request):
@@ -106,22 +251,22 @@ async def auth_callback(request: Request, code: str | None = None, state: str |
     """
     if error:
         # For example: access_denied if user cancels
-        return templates.TemplateResponse("error.html", {"request": request, "message": f"Login failed: {error}", "user": request.session.get("user")})
+        return templates.TemplateResponse("error.html", base_ctx(request) | {"message": f"Login failed: {error}"})
 
     if not code or not state:
-        return templates.TemplateResponse("error.html", {"request": request, "message": "Missing code or state", "user": request.session.get("user")})
+        return templates.TemplateResponse("error.html", base_ctx(request) | {"message": "Missing code or state"})
 
     # Validate state (basic CSRF protection)
-    saved_state = request.session.get("state")
+    saved_state = request.cookies.get(STATE_COOKIE)
     if not saved_state or saved_state != state:
-        return templates.TemplateResponse("error.html", {"request": request, "message": "Invalid state", "user": request.session.get("user")})
+        return templates.TemplateResponse("error.html", base_ctx(request) | {"message": "Invalid state"})
 
     # Exchange authorization code for tokens
     result = acquire_token_by_authorization_code(code)
 
     if "error" in result:
         msg = result.get("error_description") or result["error"]
-        return templates.TemplateResponse("error.html", {"request": request, "message": f"Token error: {msg}", "user": request.session.get("user")})
+        return templates.TemplateResponse("error.html", base_ctx(request) | {"message": f"Token error: {msg}"})
 
     id_token_claims = result.get("id_token_claims", {})
 
@@ -137,16 +282,24 @@ async def auth_callback(request: Request, code: str | None = None, state: str |
         "is_admin": "Admin" in roles,
     }
 
-    # Clear one-time state
-    request.session.pop("state", None)
+    # New session id on sign-in, so an id issued before login can't be reused
+    await regenerate_session(request)
 
-    return RedirectResponse(url="/")
+    # Clear one-time state
+    response = RedirectResponse(url="/")
+    response.delete_cookie(
+        STATE_COOKIE,
+        path=REDIRECT_PATH,
+        secure=APP_BASE_URL.startswith("https://"),
+        httponly=True,
+    )
+    return response
 
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, user=Depends(get_current_user)):
+async def dashboard(request: Request, user=Depends(get_current_user), s3_client=Depends(get_s3_client)):
     # List JSON files from S3
     try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME)
+        response = await s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME)
     except Exception as e:
         # If listing fails, show empty list but render page
         print(f"Error listing S3 objects: {e}")
@@ -186,89 +339,179 @@ async def dashboard(request: Request, user=Depends(get_current_user)):
 
     return templates.TemplateResponse(
         "dashboard.html",
-        {
-            "request": request,
-            "user": user,
+        base_ctx(request) | {
             "json_files": json_files,
             "image_default": image_default
         },
     )
 
+MAX_IMAGES = 100
+
+UPLOAD_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+class ConvertFormParser(MultiPartParser):
+    # Keep typical photos in memory instead of rolling each one over to a temp file
+    spool_max_size = UPLOAD_SPOOL_MAX_SIZE
+
+async def read_convert_form(request: Request) -> FormData:
+    """
+    Parse the /convert multipart body once, with limits sized for this form
+    (json_key, pdf, and an image + category + note per photo).
+    The caller is responsible for closing the returned form.
+    """
+    content_type = request.headers.get("Content-Type", "")
+    if not content_type.lower().startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body.")
+
+    parser = ConvertFormParser(
+        request.headers,
+        request.stream(),
+        max_files=MAX_IMAGES + 1,
+        max_fields=2 * MAX_IMAGES + 1,
+    )
+    try:
+        return await parser.parse()
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+
+# Each required category owns one bit; a request is complete when every bit is set
 REQUIRED_CATEGORIES = {
-    "coverPhoto",
-    "characteristicHeatExchanger",
-    "characteristicOpeningStructure",
+    category: 1 << i
+    for i, category in enumerate((
+        "coverPhoto",
+        "characteristicHeatExchanger",
+        "characteristicOpeningStructure",
+    ))
 }
+REQUIRED_CATEGORIES_MASK = sum(REQUIRED_CATEGORIES.values())
 
-@app.post("/convert")
-async def convert(
-    request: Request,
-    json_key: str = Form(...),
-    pdf: UploadFile = File(...),
-    images: list[UploadFile] = File(...),
-    categories: list[str] = Form(...),
-    notes: list[str] = Form(...),
-):
-    # Basic consistency checks
-    if len(images) != len(categories) or len(images) != len(notes):
-        raise HTTPException(status_code=400, detail="Number of images, categories and notes must match.")
-
-    # Enforce required categories at least once
-    present_cats = set(categories)
-    if not REQUIRED_CATEGORIES.issubset(present_cats):
-        missing = REQUIRED_CATEGORIES - present_cats
-        raise HTTPException(
-            status_code=400,
-            detail=f"Missing required image categories: {', '.join(sorted(missing))}",
-        )
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
 
-    # --- Download JSON from S3 ---
+def loads_json(data: bytes):
     try:
-        obj = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=json_key)
-        raw_json_bytes = obj["Body"].read()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to download JSON from S3: {e}")
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson rejects NaN/Infinity literals, which the json module accepts
+        return pyjson.loads(data)
 
-    # Parse JSON
+def dumps_json(obj) -> bytes:
     try:
-        input_obj = pyjson.loads(raw_json_bytes.decode("utf-8"))
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON content in S3 object.")
-
-    # Read PDF bytes
-    pdf_bytes = await pdf.read()
-
-    # Read image bytes and assemble metadata (note = filename without extension)
-    images_meta = []
-    for img_file, category, note in zip(images, categories, notes):
-        content = await img_file.read()
-
-        images_meta.append(
-            {
-                "content": content,
-                "note": note,
-                "category": category,
-            }
-        )
+        return orjson.dumps(obj, option=JSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        # orjson only serializes integers that fit in 64 bits; the json module has no limit
+        return pyjson.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
 
-    # Transform using your core logic
-    result_dict = transform_json(input_obj, pdf_bytes, images_meta)
-
-    # Encode to JSON bytes
-    output_bytes = pyjson.dumps(result_dict, ensure_ascii=False, indent=2).encode("utf-8")
+async def stream_converted_json(head: bytes, pdf, photos: list, form) -> AsyncIterator[bytes]:
+    """
+    Write the converted JSON exactly as dumps_json would,
+    with "calculationsPdfFileContent" and "photos" as the last two keys -
+    but with their base64 content streamed straight from the uploads
+    instead of being built in memory first.
+    head: the serialized document without its closing "\n}".
+    photos: list of (upload, category, note) tuples.
+    The form (and with it every upload) is closed once the stream ends.
+    """
+    try:
+        yield head
+
+        yield b',\n  "calculationsPdfFileContent": "'
+        async for chunk in iter_base64(pdf):
+            yield chunk
+        yield b'",\n  "photos": ['
+
+        for i, (img_file, category, note) in enumerate(photos):
+            yield (
+                (b",\n    {" if i else b"\n    {")
+                + b'\n      "category": ' + orjson.dumps(category)
+                + b',\n      "note": ' + orjson.dumps(note)
+                + b',\n      "content": "'
+            )
+            async for chunk in iter_base64(img_file):
+                yield chunk
+            yield b'"\n    }'
+
+        yield b"\n  ]\n}" if photos else b"]\n}"
+    finally:
+        await form.close()
 
-    # --- Delete original JSON from S3 after successful conversion ---
+@app.post("/convert")
+async def convert(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    s3_client=Depends(get_s3_client),
+):
+    form = await read_convert_form(request)
     try:
-        s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=json_key)
-    except Exception as e:
-        # Not fatal for the download; just log it
-        print(f"Failed to delete original JSON from S3 ({json_key}): {e}")
+        json_key = None
+        pdf = None
+        images, categories, notes = [], [], []
+        present_mask = 0
+
+        # One pass over the form: collect the fields, check their types and
+        # track the required categories as they come (before any upload is read)
+        for name, value in form.multi_items():
+            match name, isinstance(value, StarletteUploadFile):
+                case "json_key", False:
+                    json_key = value
+                case "pdf", True:
+                    pdf = value
+                case "images", True:
+                    images.append(value)
+                case "categories", False:
+                    categories.append(value)
+                    present_mask |= REQUIRED_CATEGORIES.get(value, 0)
+                case "notes", False:
+                    notes.append(value)
+                case ("json_key" | "pdf" | "images" | "categories" | "notes"), _:
+                    raise HTTPException(status_code=400, detail=f"Invalid value for form field {name}.")
+
+        if json_key is None or pdf is None:
+            raise HTTPException(status_code=400, detail="Missing json_key or pdf.")
+
+        # Basic consistency checks
+        if len(images) != len(categories) or len(images) != len(notes):
+            raise HTTPException(status_code=400, detail="Number of images, categories and notes must match.")
+
+        # Enforce required categories at least once
+        if present_mask != REQUIRED_CATEGORIES_MASK:
+            missing = [cat for cat, bit in REQUIRED_CATEGORIES.items() if not present_mask & bit]
+            raise HTTPException(
+                status_code=400,
+                detail=f"Missing required image categories: {', '.join(sorted(missing))}",
+            )
+
+        # --- Download JSON from S3 ---
+        try:
+            raw_json_bytes = await read_s3_object(s3_client, json_key)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to download JSON from S3: {e}")
+
+        # Parse JSON
+        try:
+            input_obj = loads_json(raw_json_bytes)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid JSON content in S3 object.")
+
+        # Transform using your core logic
+        result_dict = transform_json(input_obj)
+
+        # Everything but the closing "\n}" of the top-level object. Serialized
+        # before the response starts, so a failure here is still an error response.
+        head = dumps_json(result_dict)[:-2]
+
+        # --- Delete original JSON from S3 after successful conversion ---
+        # Runs once the response has been sent, so it is off the critical path
+        background_tasks.add_task(delete_s3_object, s3_client, json_key)
+    except BaseException:
+        await form.close()
+        raise
 
     lead_code = json_key.split("-")[0]
 
-    # Return as downloadable file
+    # Return as downloadable file; PDF and images (note = filename without extension)
+    # are base64-encoded while the response is being sent
     return StreamingResponse(
-        io.BytesIO(output_bytes),
+        stream_converted_json(head, pdf, list(zip(images, categories, notes)), form),
         media_type="application/json",
         headers={"Content-Disposition": f'attachment; filename="{lead_code}.json"'},
     )
\ No newline at end of file
@@ -1,7 +1,12 @@
+from functools import cache
+
 import msal
 from .config import AUTHORITY, CLIENT_ID, CLIENT_SECRET, SCOPES, REDIRECT_URI
 
+@cache
 def build_msal_app():
+    # Built once per process: authority discovery runs a single time
+    # and its in-memory token cache is shared by every caller.
     return msal.ConfidentialClientApplication(
         CLIENT_ID,
         authority=AUTHORITY,
@@ -23,4 +28,10 @@ def acquire_token_by_authorization_code(code: str):
         scopes=SCOPES,
         redirect_uri=REDIRECT_URI,
     )
+    # Only the ID token claims are kept (in the session), so don't let every
+    # signed-in user pile up in the shared token cache.
+    username = (result.get("id_token_claims") or {}).get("preferred_username")
+    if username:
+        for account in app.get_accounts(username=username):
+            app.remove_account(account)
     return result
\ No newline at end of file
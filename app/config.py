@@ -9,6 +9,11 @@ CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 APP_BASE_URL = os.getenv("APP_BASE_URL", "http://localhost:8000")
 SESSION_SECRET = os.getenv("SESSION_SECRET", "ultrasecretsessionsecret2025")
 
+# Sessions are stored server-side (Redis if configured, otherwise in-process)
+# and expire after SESSION_TTL seconds of inactivity
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+
 if not all([TENANT_ID, CLIENT_ID, CLIENT_SECRET]):
     raise RuntimeError("TENANT_ID, CLIENT_ID, CLIENT_SECRET must be set in .env")
 
@@ -1,8 +1,6 @@
-import re
-from collections import OrderedDict
-from typing import Any, Dict, List
-import base64
-from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+from datetime import date
 
 # Split entries to 4 arrays based on types
 
@@ -12,18 +10,28 @@ def split_entries(entries):
     mps = []   # modernisationProposalsOfBuildingServicesSystems
     other = []
 
+    buckets = {
+        "boundaryAndOpeningStructures": boundary,
+        "modernisationProposalDetails": mpd,
+        "modernisationProposalsOfBuildingServicesSystems": mps,
+    }
+
     for key, value in entries:
-        if key.startswith("boundaryAndOpeningStructures__"):
-            boundary.append([key, value])
-        elif key.startswith("modernisationProposalDetails__"):
-            mpd.append([key, value])
-        elif key.startswith("modernisationProposalsOfBuildingServicesSystems__"):
-            mps.append([key, value])
-        else:
-            other.append([key, value])
+        head, sep, _ = key.partition("__")
+        bucket = buckets.get(head, other) if sep else other
+        bucket.append((key, value))
 
     return boundary, mpd, mps, other
 
+# Split flat key into segments (the schema is fixed, so the same keys come
+# back on every request and the split is cached)
+
+@lru_cache(maxsize=4096)
+def split_key(flat_key: str, prefix: str = "") -> Tuple[str, ...]:
+    if prefix:
+        flat_key = flat_key.removeprefix(prefix).lstrip("_")
+    return tuple(flat_key.split("__"))
+
 # Normalize value
 
 def normalize_value(raw: Any) -> Any:
@@ -47,33 +55,35 @@ def normalize_value(raw: Any) -> Any:
     if not s:
         return raw
 
+    # Integers are the common case: parse them directly, without a regex or a float round-trip
+    digits = s[1:] if s[0] == "-" else s
+    if digits.isdecimal():
+        return int(s)
+
     try:
-        num = float(s)
-        if re.fullmatch(r"-?\d+", s):
-            return int(num)
-        return num
+        return float(s)
     except ValueError:
         return raw
 
 # Process boundary and opening structures
 
 def process_boundary(entries):
-    structures_by_type: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    structures_by_type: Dict[str, Dict[str, Any]] = {}
 
-    for i in range(0, len(entries), 4):
-        group = entries[i:i+4]
+    values = [value for _, value in entries]
 
-        if len(group) < 4:
-            continue
-
-        type_of_structure = normalize_value(group[0][1])
-        quality = normalize_value(group[1][1])
-        u = normalize_value(group[2][1])
-        dimension = normalize_value(group[3][1])
+    # Only complete groups of 4; skipped groups are not normalized any further
+    for i in range(0, len(values) - 3, 4):
+        raw_type, raw_quality, raw_u, raw_dimension = values[i:i+4]
 
+        quality = normalize_value(raw_quality)
         if quality is None or (isinstance(quality, str) and quality.strip() == ""):
             continue
 
+        type_of_structure = normalize_value(raw_type)
+        u = normalize_value(raw_u)
+        dimension = normalize_value(raw_dimension)
+
         type_key = str(type_of_structure)
         if type_key not in structures_by_type:
             structures_by_type[type_key] = {
@@ -96,26 +106,26 @@ def process_boundary(entries):
 def process_mpd(entries):
     proposals = []
 
-    for i in range(0, len(entries), 10):
-        group = entries[i:i+10]
-
-        if len(group) < 10:
-            continue
-
-        structure_type = normalize_value(group[0][1])
-        structure_note = normalize_value(group[1][1])
-        structure_surface_area = normalize_value(group[2][1])
-        air_tightness = normalize_value(group[3][1])
-        note = normalize_value(group[4][1])
-        current_state_value = normalize_value(group[5][1])
-        good_u = normalize_value(group[6][1])
-        good_dimensions = normalize_value(group[7][1])
-        excellent_u = normalize_value(group[8][1])
-        excellent_dimensions = normalize_value(group[9][1])
+    values = [value for _, value in entries]
 
+    # Only complete groups of 10; skipped groups are not normalized any further
+    for i in range(0, len(values) - 9, 10):
+        structure_type = normalize_value(values[i])
         if structure_type is None or (isinstance(structure_type, str) and structure_type.strip() == ""):
             continue
 
+        (
+            structure_note,
+            structure_surface_area,
+            air_tightness,
+            note,
+            current_state_value,
+            good_u,
+            good_dimensions,
+            excellent_u,
+            excellent_dimensions,
+        ) = map(normalize_value, values[i+1:i+10])
+
         proposals.append({
             "structureType": structure_type,
             "structureNote": structure_note,
@@ -149,7 +159,7 @@ def process_mps(entries):
 
     # Per-system grouping of recommendedModernisations by category
     # key: category string or None (for empty/missing category)
-    recommended_by_cat: OrderedDict[Any, Dict[str, Any]] | None = None
+    recommended_by_cat: Dict[Any, Dict[str, Any]] | None = None
 
     current_recommended: Dict[str, Any] | None = None
     current_element: Dict[str, Any] | None = None
@@ -159,7 +169,7 @@ def process_mps(entries):
         nonlocal recommended_by_cat, current_recommended
 
         if recommended_by_cat is None:
-            recommended_by_cat = OrderedDict()
+            recommended_by_cat = {}
 
         # Normalize category: empty string or None => key None (category-less group)
         if cat_value in ("", None):
@@ -220,67 +230,53 @@ def process_mps(entries):
         current_element = None
 
     # ---------------- main loop ----------------
+    prefix = "modernisationProposalsOfBuildingServicesSystems__"
+
     for flat_key, raw_value in entries:
         value = normalize_value(raw_value)
 
-        prefix = "modernisationProposalsOfBuildingServicesSystems__"
-        _, suffix = flat_key.split(prefix, 1)
-        suffix = suffix.lstrip("_")
-        parts = suffix.split("__")
-
-        # ---- buildingServiceSystemType: new system ----
-        if parts[0] == "buildingServiceSystemType":
-            finalize_system()
-            current_system = {"buildingServiceSystemType": value}
-            current_actual = None
-            recommended_by_cat = None
-            current_recommended = None
-            current_element = None
-            continue
-
-        # ---- top-level note ----
-        if parts[0] == "note" and len(parts) == 1:
-            if current_system is None:
-                current_system = {}
-            current_system["note"] = value
-            continue
-
-        # ---- actualEnergeticQuality ----
-        if parts[0] == "actualEnergeticQuality" and len(parts) == 2:
-            field = parts[1]  # "quality" or "note"
-            if current_actual is None:
-                current_actual = {}
-            current_actual[field] = value
-            continue
-
-        # ---- recommendedModernisations ----
-        if parts[0] == "recommendedModernisations":
-            # modernisationCategory: select or create the group
-            if len(parts) == 2 and parts[1] == "modernisationCategory":
+        parts = split_key(flat_key, prefix)
+
+        match parts:
+            # ---- buildingServiceSystemType: new system ----
+            case ["buildingServiceSystemType", *_]:
+                finalize_system()
+                current_system = {"buildingServiceSystemType": value}
+                current_actual = None
+                recommended_by_cat = None
+                current_recommended = None
+                current_element = None
+
+            # ---- top-level note ----
+            case ["note"]:
+                if current_system is None:
+                    current_system = {}
+                current_system["note"] = value
+
+            # ---- actualEnergeticQuality ----
+            case ["actualEnergeticQuality", field]:  # "quality" or "note"
+                if current_actual is None:
+                    current_actual = {}
+                current_actual[field] = value
+
+            # ---- recommendedModernisations: select or create the category group ----
+            case ["recommendedModernisations", "modernisationCategory"]:
                 # finishing any open element before switching category
                 finalize_element()
                 get_or_create_recommended(value)
-                continue
-
-            # systemElements__...
-            if len(parts) == 3 and parts[1] == "systemElements":
-                field = parts[2]  # "name", "description", "isExcellentLevel"
-
-                if field == "name":
-                    # New element: flush previous element first
-                    finalize_element()
-                    current_element = {"name": value}
-                elif field == "description":
-                    if current_element is None:
-                        current_element = {}
-                    current_element["description"] = value
-                elif field == "isExcellentLevel":
-                    if current_element is None:
-                        current_element = {}
-                    current_element["isExcellentLevel"] = value
-                continue
-
-        # anything else is ignored
+
+            # ---- recommendedModernisations__systemElements__... ----
+            case ["recommendedModernisations", "systemElements", "name"]:
+                # New element: flush previous element first
+                finalize_element()
+                current_element = {"name": value}
+
+            case ["recommendedModernisations", "systemElements", ("description" | "isExcellentLevel") as field]:
+                if current_element is None:
+                    current_element = {}
+                current_element[field] = value
+
+            # anything else is ignored
 
     # finalize last system
     finalize_system()
@@ -295,6 +291,9 @@ def process_other(entries):
 
     alternative_energies: List[str] = []
 
+    prev_path: List[str] = []
+    prev_nodes: List[Dict[str, Any]] = [result]
+
     for flat_key, raw_value in entries:
         value = normalize_value(raw_value)
 
@@ -303,7 +302,7 @@ def process_other(entries):
             # Example key: "usingAlternativeEnergy__alternativeEnergies__HeatPump"
             # We only add names where value is TRUE
             if value is True:
-                name = flat_key.split("__")[-1]
+                name = split_key(flat_key)[-1]
                 alternative_energies.append(name)
             # Skip generic processing for these keys
             continue
@@ -312,25 +311,34 @@ def process_other(entries):
         if value in ("", None):
             continue
 
-        keys = flat_key.split("__")
-
-        current = result
-        for idx, key in enumerate(keys):
-            is_last = idx == len(keys) - 1
-
-            if is_last:
-                arr_match = re.match(r"(.+)_\d+$", key)
-                if arr_match:
-                    arr_key = arr_match.group(1)
-                    if arr_key not in current or not isinstance(current[arr_key], list):
-                        current[arr_key] = []
-                    current[arr_key].append(value)
-                else:
-                    current[key] = value
-            else:
-                if key not in current or not isinstance(current[key], dict):
-                    current[key] = {}
-                current = current[key]
+        *path, key = split_key(flat_key)
+
+        # Consecutive keys mostly share their parent path, so resume from the
+        # deepest dict the previous key reached instead of walking from the root
+        common = 0
+        for part, prev_part in zip(path, prev_path):
+            if part != prev_part:
+                break
+            common += 1
+
+        nodes = prev_nodes[:common + 1]
+        current = nodes[-1]
+        for part in path[common:]:
+            child = current.get(part)
+            if not isinstance(child, dict):
+                child = current[part] = {}
+            current = child
+            nodes.append(current)
+        prev_path, prev_nodes = path, nodes
+
+        # Keys like "name_1", "name_2" collect into a "name" list
+        arr_key, _, index = key.rpartition("_")
+        if arr_key and index.isdecimal():
+            if not isinstance(current.get(arr_key), list):
+                current[arr_key] = []
+            current[arr_key].append(value)
+        else:
+            current[key] = value
     
     # After processing all entries, attach the collected alternativeEnergies
     if alternative_energies:
@@ -339,22 +347,42 @@ def process_other(entries):
 
     return result
 
+# Numeric-looking fields that must be sent as strings, grouped by their parent dict
+
+STRING_FIELDS = [
+    (("buildingData", "buildingAddress"), ("houseNumber", "building", "floor", "doorNumber", "staircase")),
+    (("buildingData",), ("topographicalNumber",)),
+    (("certifierDetails", "address"), ("houseNumber", "building", "floor", "doorNumber", "staircase")),
+    (("certifierDetails",), ("topographicalNumber",)),
+]
+
+# Convert "M/D/YYYY" to "YYYY.MM.DD."
+# (same result and ValueError on bad input as strptime("%m/%d/%Y"), without its per-call overhead)
+
+def format_inspection_date(value: str) -> str:
+    month, day, year = value.split("/")
+    if not (
+        value.isascii()
+        and 0 < len(month) <= 2 and month.isdecimal()
+        and 0 < len(day) <= 2 and day.isdecimal()
+        and len(year) == 4 and year.isdecimal()
+    ):
+        raise ValueError(f"Invalid date: {value!r}")
+
+    d = date(int(year), int(month), int(day))
+    return f"{d.year:04d}.{d.month:02d}.{d.day:02d}."
+
 # Main process
 
-def transform_json(
-    input_obj: Dict[str, Any],
-    pdf_bytes: bytes,
-    images: List[Dict[str, Any]],   # each: {"content": bytes, "note": str, "category": str}
-) -> Dict[str, Any]:
+def transform_json(input_obj: Dict[str, Any]) -> Dict[str, Any]:
     """
     Pure-function version of the transformer.
 
     - input_obj: parsed JSON of the "pairs" file
-    - pdf_bytes: raw bytes of the calculations PDF
-    - images: list of dicts with keys:
-        - "content": bytes
-        - "note": str
-        - "category": one of the allowed categories
+
+    The calculations PDF and the photos are not part of the result
+    (any such keys from the pairs file are dropped);
+    the caller appends them as "calculationsPdfFileContent" and "photos".
     """
     entries = input_obj.get("data", [])
 
@@ -376,70 +404,20 @@ def transform_json(
         result["modernisationProposalsOfBuildingServicesSystems"] = mps_processed
 
     # Force some numeric-ish address fields to strings
-    result["buildingData"]["buildingAddress"]["houseNumber"] = str(
-        result["buildingData"]["buildingAddress"]["houseNumber"]
-    )
-    result["buildingData"]["buildingAddress"]["building"] = str(
-        result["buildingData"]["buildingAddress"]["building"]
-    )
-    result["buildingData"]["buildingAddress"]["floor"] = str(
-        result["buildingData"]["buildingAddress"]["floor"]
-    )
-    result["buildingData"]["buildingAddress"]["doorNumber"] = str(
-        result["buildingData"]["buildingAddress"]["doorNumber"]
-    )
-    result["buildingData"]["buildingAddress"]["staircase"] = str(
-        result["buildingData"]["buildingAddress"]["staircase"]
-    )
-    result["buildingData"]["topographicalNumber"] = str(
-        result["buildingData"]["topographicalNumber"]
-    )
-
-    result["certifierDetails"]["address"]["houseNumber"] = str(
-        result["certifierDetails"]["address"]["houseNumber"]
-    )
-    result["certifierDetails"]["address"]["building"] = str(
-        result["certifierDetails"]["address"]["building"]
-    )
-    result["certifierDetails"]["address"]["floor"] = str(
-        result["certifierDetails"]["address"]["floor"]
-    )
-    result["certifierDetails"]["address"]["doorNumber"] = str(
-        result["certifierDetails"]["address"]["doorNumber"]
-    )
-    result["certifierDetails"]["address"]["staircase"] = str(
-        result["certifierDetails"]["address"]["staircase"]
-    )
-    result["certifierDetails"]["topographicalNumber"] = str(
-        result["certifierDetails"]["topographicalNumber"]
-    )
-    result["certifierDetails"]["phoneNumber"] = "+" + str(
-        result["certifierDetails"]["phoneNumber"]
-    )
-
-    result["validity"]["siteInspectionDate"] = datetime.strptime(result["validity"]["siteInspectionDate"], "%m/%d/%Y").strftime("%Y.%m.%d.")
-
-    # --- PDF -> base64 ---
-    pdf_b64 = base64.b64encode(pdf_bytes).decode("ascii")
-    result["calculationsPdfFileContent"] = pdf_b64
-
-    # --- Images -> photos (use category provided from frontend) ---
-    photos = []
-    for img in images:
-        raw = img["content"]
-        note = img.get("note", "")
-        category = img.get("category")
-
-        img_b64 = base64.b64encode(raw).decode("ascii")
-
-        photos.append(
-            {
-                "category": category,
-                "note": note,
-                "content": img_b64,
-            }
-        )
+    for parent_path, fields in STRING_FIELDS:
+        parent = result
+        for key in parent_path:
+            parent = parent[key]
+        for field in fields:
+            parent[field] = str(parent[field])
+
+    certifier = result["certifierDetails"]
+    certifier["phoneNumber"] = f"+{certifier['phoneNumber']}"
+
+    result["validity"]["siteInspectionDate"] = format_inspection_date(result["validity"]["siteInspectionDate"])
 
-    result["photos"] = photos
+    # These are appended by the caller; drop any same-named keys from the pairs file
+    result.pop("calculationsPdfFileContent", None)
+    result.pop("photos", None)
 
     return result
\ No newline at end of file
@@ -0,0 +1,44 @@
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from starlette.requests import HTTPConnection
+from starsessions import SessionStore, get_session_handler, regenerate_session_id
+from starsessions.stores.redis import RedisStore
+
+from .config import REDIS_URL, SESSION_TTL
+
+class TTLCacheStore(SessionStore):
+    """
+    Per-process session store for deploys without Redis.
+    A session expires SESSION_TTL seconds after it was last written.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = SESSION_TTL):
+        self.data = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def read(self, session_id: str, lifetime: int) -> bytes:
+        return self.data.get(session_id, b"")
+
+    async def write(self, session_id: str, data: bytes, lifetime: int, ttl: int) -> str:
+        self.data[session_id] = data
+        return session_id
+
+    async def remove(self, session_id: str) -> None:
+        self.data.pop(session_id, None)
+
+def build_session_store() -> SessionStore:
+    # Redis shares sessions between worker processes; the in-process cache does not
+    if REDIS_URL:
+        return RedisStore(connection=Redis.from_url(REDIS_URL))
+    return TTLCacheStore()
+
+async def regenerate_session(connection: HTTPConnection) -> str:
+    """
+    Move the session to a new id and drop the old id's entry from the store,
+    instead of leaving it behind until it expires.
+    """
+    handler = get_session_handler(connection)
+    old_id = handler.session_id
+    new_id = regenerate_session_id(connection)
+    if old_id:
+        await handler.store.remove(old_id)
+    return new_id